@@ -7,53 +7,278 @@ A candidate mixing package for invariant mass spectrum using Ostap.
 """
 
 import ROOT
+import numpy as np
 import warnings
 import os.path
 import sys
-import array
-import numbers
-from collections import OrderedDict
+import tempfile
+import contextlib
+import math
+from collections import deque
+from itertools import chain
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# ROOT.RDF.MakeNumpyDataFrame is deprecated in favour of ROOT.RDF.FromNumpy.
+_fromNumpy = getattr(ROOT.RDF, "FromNumpy", None)
+if _fromNumpy is None:
+    _fromNumpy = ROOT.RDF.MakeNumpyDataFrame
 
 # Always display warnings.
 warnings.simplefilter("always")
 
-class _AnnaOrderedDict(OrderedDict):
-    """An OrderedDict with a prepend method.
+@contextlib.contextmanager
+def _implicitMTDisabled():
+    """Disable ROOT implicit multi-threading inside a with block.
 
-    Methods
+    Implicit multi-threading does not preserve entry order when reading or
+    writing trees. If enabled, it is restored with the same number of threads
+    at the end of the block.
+    """
+
+    n_threads = 0
+    if ROOT.IsImplicitMTEnabled():
+        n_threads = ROOT.GetThreadPoolSize()
+        ROOT.DisableImplicitMT()
+
+    try:
+        yield
+    finally:
+        if n_threads > 0:
+            ROOT.EnableImplicitMT(n_threads)
+
+def _mixVectorized(p4, mpty, entries, mix_cand, out):
+    """Mix entries of an event with train entries.
+
+    Every entry is mixed with every window of consecutive train entries, one
+    train entry per stem but the first one. Windows are the same for all the
+    entries of the event, so train candidates are read and summed once per
+    window.
+
+    Parameters
+    ----------
+    p4 : numpy.ndarray
+        PX, PY, PZ and PE of every stem, shape (n_stems, 4, n_entries).
+    mpty : numpy.ndarray
+        M, PT and Y of every stem, shape (n_stems, 3, n_entries).
+    entries : numpy.ndarray
+        Indexes of the entries of the event to be mixed with the train.
+    mix_cand : numpy.ndarray
+        Indexes of all the entries in the train.
+    out : numpy.ndarray
+        Filled with mixed candidates M, PT, Y, daughters M, PT, Y and weight,
+        one row per mixed candidate, entry after entry.
+    """
+
+    n_stems   = p4.shape[0]
+    n_entries = len(entries)
+    n_mix     = out.shape[0] // n_entries
+
+    # Train candidates of every window, stem k being taken from window k of
+    # mix_cand.
+    train_p = np.zeros((4, n_mix))
+    for k in range(1, n_stems):
+        train_index = mix_cand[k-1:k-1+n_mix]
+        train_p += p4[k][:, train_index]
+        out[:, 3+3*k:6+3*k] = np.tile(mpty[k][:, train_index], n_entries).T
+
+    # Current candidates added to every window.
+    p = (p4[0][:, entries, np.newaxis]
+         + train_p[:, np.newaxis, :]).reshape(4, n_entries*n_mix)
+    out[:, 3:6] = np.repeat(mpty[0][:, entries], n_mix, axis=1).T
+
+    # Same conventions as ROOT.TLorentzVector. Results are written directly
+    # in out, rows of p being reused as scratch space once not needed.
+    px, py, pz, pe = p
+    mass, pt, rapidity = out[:, 0], out[:, 1], out[:, 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Mass squared.
+        np.multiply(pe, pe, out=mass)
+        for component in (px, py, pz):
+            np.multiply(component, component, out=rapidity)
+            mass -= rapidity
+
+        np.hypot(px, py, out=pt)
+
+        np.add(pe, pz, out=rapidity)
+        np.subtract(pe, pz, out=px)
+        rapidity /= px
+        np.log(rapidity, out=rapidity)
+        rapidity *= 0.5
+
+        # Negative mass for space-like vectors.
+        np.sign(mass, out=py)
+        np.abs(mass, out=mass)
+        np.sqrt(mass, out=mass)
+        mass *= py
+    out[:, 3+3*n_stems] = n_mix
+
+# Source of the numba mixing kernel, same as _mixVectorized with loops over
+# windows and entries. Train stems are unrolled by _buildMixKernel.
+_MIX_KERNEL_SOURCE = """
+def _mixKernel(p4, mpty, entries, mix_cand, out):
+    n_entries = len(entries)
+    n_mix     = out.shape[0] // n_entries
+
+    for n in range(n_mix):
+        # Train candidates of the window, shared by every entry.{train_stems}
+
+        train_px = 0.0{sum_px}
+        train_py = 0.0{sum_py}
+        train_pz = 0.0{sum_pz}
+        train_pe = 0.0{sum_pe}
+
+        for e in range(n_entries):
+            # Current candidate.
+            entry = entries[e]
+            row   = e*n_mix + n
+            px = p4[0, 0, entry] + train_px
+            py = p4[0, 1, entry] + train_py
+            pz = p4[0, 2, entry] + train_pz
+            pe = p4[0, 3, entry] + train_pe
+            out[row, 3] = mpty[0, 0, entry]
+            out[row, 4] = mpty[0, 1, entry]
+            out[row, 5] = mpty[0, 2, entry]{train_daughters}
+
+            # Same conventions as ROOT.TLorentzVector.
+            m2 = pe*pe - px*px - py*py - pz*pz
+            if m2 < 0:
+                out[row, 0] = -math.sqrt(-m2)
+            else:
+                out[row, 0] = math.sqrt(m2)
+            out[row, 1] = math.hypot(px, py)
+            out[row, 2] = 0.5 * math.log((pe + pz) / (pe - pz))
+            out[row, {weight}] = n_mix
+"""
+
+# Source of the block reading train stem number {k} in _MIX_KERNEL_SOURCE.
+_MIX_KERNEL_STEM_SOURCE = """
+        i_{k}  = mix_cand[n+{window}]
+        m_{k}  = mpty[{k}, 0, i_{k}]
+        pt_{k} = mpty[{k}, 1, i_{k}]
+        y_{k}  = mpty[{k}, 2, i_{k}]"""
+
+# Source of the block copying train stem number {k} in _MIX_KERNEL_SOURCE.
+_MIX_KERNEL_DAUGHTER_SOURCE = """
+            out[row, {m}] = m_{k}
+            out[row, {pt}] = pt_{k}
+            out[row, {y}] = y_{k}"""
+
+_mix_kernels = {} # {n_stems: (compiled kernel, compiled events mixing)}
+
+def _buildMixKernel(n_stems):
+    """Generate and compile the mixing kernel for the given number of stems.
+
+    Unrolling the loop over train stems leaves only the loops over windows
+    and entries in the compiled kernel.
+
+    Parameters
+    ----------
+    n_stems : int
+        Number of stems to mix.
+
+    Returns
     -------
-    prepend(key, value)
-        Append given key with given value to the left of the dictionnary.
+    function
+        Kernel with the same signature as _mixVectorized.
     """
 
-    def prepend(self, key, value, dict_setitem=dict.__setitem__):
-        """Append given key with given value to the left of the dictionnary.
+    train_stems = range(1, n_stems)
+    sums = {}
+    for c, var in enumerate(["px", "py", "pz", "pe"]):
+        sums["sum_" + var] = "".join(" + p4[{}, {}, i_{}]".format(k, c, k)
+                                     for k in train_stems)
+
+    source = _MIX_KERNEL_SOURCE.format(
+        train_stems="".join(_MIX_KERNEL_STEM_SOURCE.format(k=k, window=k-1)
+                            for k in train_stems),
+        train_daughters="".join(_MIX_KERNEL_DAUGHTER_SOURCE.format(k=k,
+                                                                   m=3+3*k,
+                                                                   pt=4+3*k,
+                                                                   y=5+3*k)
+                                for k in train_stems),
+        weight=3+3*n_stems,
+        **sums)
+
+    namespace = {"math": math}
+    exec(source, namespace)
+    return numba.njit(error_model="numpy")(namespace["_mixKernel"])
+
+def _buildMixEvents(kernel):
+    """Compile a function mixing a range of events in parallel.
+
+    Once its train is known, every event fills its own rows of the output
+    independently of the others, so events are shared between threads.
+
+    Parameters
+    ----------
+    kernel : function
+        Compiled mixing kernel, see _buildMixKernel.
+
+    Returns
+    -------
+    function
+        mixEvents(p4, mpty, tree_index, event_boundaries, train_length,
+        event_rows, output, first, last), mixing events first to last
+        (excluded) into output, starting at the first row of event first.
+    """
 
-        If given key is already a key of the dictionnary, it is moved to the
-        left, and it's value is not updated.
+    def mixEvents(p4, mpty, tree_index, event_boundaries, train_length,
+                  event_rows, output, first, last):
+        n_events = len(event_boundaries) - 1
+        offset   = event_rows[first]
+
+        for g in numba.prange(first, last):
+            # List of all the indexes in the train: the train_length events
+            # preceding the current one, most recent first, wrapping around
+            # to the last events of the tree.
+            n_train = 0
+            for j in range(1, train_length + 1):
+                h = (g - j) % n_events
+                n_train += event_boundaries[h+1] - event_boundaries[h]
+            mix_cand = np.empty(n_train, dtype=np.int64)
+            n_train  = 0
+            for j in range(1, train_length + 1):
+                h = (g - j) % n_events
+                for e in range(event_boundaries[h], event_boundaries[h+1]):
+                    mix_cand[n_train] = tree_index[e]
+                    n_train += 1
 
-        Parameters
-        ----------
-        key
-            New key to add to the left of the dictionnary.
-        value
-            Value associated with the new key.
-        """
+            # Mix event wagon with train.
+            kernel(p4, mpty,
+                   tree_index[event_boundaries[g]:event_boundaries[g+1]],
+                   mix_cand,
+                   output[:, event_rows[g]-offset:event_rows[g+1]-offset].T)
 
-        root = self._OrderedDict__root
-        first = root[1]
-
-        if key in self:
-            link = self._OrderedDict__map[key]
-            link_prev, link_next, _ = link
-            link_prev[1] = link_next
-            link_next[0] = link_prev
-            link[0] = root
-            link[1] = first
-            root[1] = first[0] = link
-        else:
-            root[1] = first[0] = self._OrderedDict__map[key] = [root, first, key]
-            dict_setitem(self, key, value)
+    return numba.njit(parallel=True, nogil=True,
+                      error_model="numpy")(mixEvents)
+
+def _getMixKernels(n_stems):
+    """Get the mixing functions for the given number of stems.
+
+    Parameters
+    ----------
+    n_stems : int
+        Number of stems to mix.
+
+    Returns
+    -------
+    tuple
+        Kernel mixing one event, compiled if numba is available and
+        _mixVectorized otherwise, and parallel function mixing a range of
+        events, None if numba is not available.
+    """
+
+    if numba is None:
+        return _mixVectorized, None
+
+    if n_stems not in _mix_kernels:
+        kernel = _buildMixKernel(n_stems)
+        _mix_kernels[n_stems] = (kernel, _buildMixEvents(kernel))
+    return _mix_kernels[n_stems]
 
 class AnnaMixEvent:
     """Class to perform candidate mixing on invariant mass, pT and rapidity.
@@ -71,10 +296,10 @@ class AnnaMixEvent:
         >>> mix.addMixCombination("J_psi_1S", ["muplus", "muminus"])
         >>> mix.runMixing()
 
-    The example above will create a "output.root" file containing a TNtuple
-    with the following branches :
+    The example above will create a "output.root" file containing a TTree
+    named "mt" with the following double precision branches :
     J_psi_1S_M, J_psi_1S_PT, J_psi_1S_Y, muplus_M, muplus_PT, muplus_Y,
-    muminus_M, muminus_PY, muminus_Y.
+    muminus_M, muminus_PY, muminus_Y, w_muplus.
 
     Here, the given TTree must contain the following branches :
     runNumber, eventNumber, muplus_PX, muplus_PY, muplus_PZ, muplus_PZ,
@@ -104,29 +329,74 @@ class AnnaMixEvent:
         Parameters
         ----------
         train_length : int
-            Number of events used for mixing.
+            Number of events used for mixing, at least 1.
         tree : instance of ROOT.TTree
             TTree to be mixed. Must have 'runNumber' and 'eventNumber'
             as branches.
         outfile_path : str
             Path for the .root file to be saved to.
+
+        Raises
+        ------
+        ValueError
+            If train_length is not a whole number of at least 1.
         """
 
-        self._train_length   = train_length
+        if not train_length >= 1 or train_length != int(train_length):
+            raise ValueError("Train length must be a whole number of at "
+                             "least 1, got {}.".format(train_length))
+
+        self._train_length   = int(train_length)
         self._tree           = tree
+        # Set[str], names of the branches of the given tree.
+        self._tree_branches  = set(branch.GetName()
+                                   for branch in tree.GetListOfBranches())
+        self._run_numbers    = None # numpy.ndarray, runNumber of each entry.
+        self._event_numbers  = None # numpy.ndarray, eventNumber of each entry.
+        self._event_keys     = None # numpy.ndarray, (run<<32)|event or None.
         self._tree_index     = self._buildTreeIndex()
         self._outfile_path   = outfile_path
-        self._train          = _AnnaOrderedDict() # {runNumber_eventNumber:[indexes]}
-        self._branchRegistry = [] # List[str], branches of final tuple.
+        # Wagons of indexes, one per event, most recent first.
+        self._train          = deque()
+        self._branchRegistry = [] # List[str], branches of saved tree.
         self._stems          = [] # List[str], daughter particules names.
+        self._p4             = None # numpy.ndarray, daughters PX, PY, PZ, PE.
+        self._mpty           = None # numpy.ndarray, daughters M, PT, Y.
+        self._mix            = None # Function mixing one event.
+        self._mix_events     = None # Function mixing events in parallel.
+
+    def _loadBranches(self, branches):
+        """Load given branches of self._tree in memory.
+
+        Reading every entry once here avoids going through TTree.GetEntry and
+        PyROOT attribute lookups for each mixed pair.
+
+        Implicit multi-threading is disabled during the read, as it does not
+        preserve entry order.
+
+        Parameters
+        ----------
+        branches : List[str]
+            Names of the branches to load.
+
+        Returns
+        -------
+        dict
+            {branch: numpy.ndarray}, values ordered as the entries of
+            self._tree.
+        """
+
+        with _implicitMTDisabled():
+            return ROOT.RDataFrame(self._tree).AsNumpy(branches)
 
     def _buildTreeIndex(self):
         """Build ordered index of self._tree.
 
         Returns
         -------
-        ROOT.TTreeIndex
-            Index of self._tree ordered in 'runNumber' and 'eventNumber'.
+        numpy.ndarray
+            Entry numbers of self._tree ordered in 'runNumber' and
+            'eventNumber'.
 
         Warns
         -----
@@ -137,130 +407,102 @@ class AnnaMixEvent:
 
         # Check if runNumber and eventNumber are branches of the given tree.
         for branch in ["runNumber", "eventNumber"]:
-            if not branch in self._tree.GetListOfBranches():
+            if not branch in self._tree_branches:
                 warnings.warn("'{}' is not a branch of the given tree, "
                               "expect problems!".format(branch))
 
-        self._tree.BuildIndex("runNumber", "eventNumber")
-        return self._tree.GetTreeIndex()
+        arrays = self._loadBranches(["runNumber", "eventNumber"])
+        self._run_numbers   = arrays["runNumber"]
+        self._event_numbers = arrays["eventNumber"]
 
-    def _buildVarlist(self):
-        """Build varlist for final tuple.
+        # Pack runNumber and eventNumber in a single key when both fit in 32
+        # bits, so that one sort and one comparison are enough.
+        fits = all(np.all((values >= 0) & (values < 2**32))
+                   for values in (self._run_numbers, self._event_numbers))
+        if fits:
+            self._event_keys = ((self._run_numbers.astype(np.uint64)
+                                 << np.uint64(32))
+                                | self._event_numbers.astype(np.uint64))
+            return np.argsort(self._event_keys, kind="stable")
+
+        # Sort on runNumber, then eventNumber.
+        return np.lexsort((self._event_numbers, self._run_numbers))
+
+    def _buildEventBoundaries(self):
+        """Find where each event starts in the ordered index.
 
         Returns
         -------
-        str
-            The varlist.
+        numpy.ndarray
+            Positions in self._tree_index of the first entry of every event,
+            followed by the size of the index. Entries of the n-th event are
+            self._tree_index[boundaries[n]:boundaries[n+1]]. Only [0] if the
+            index is empty.
         """
 
-        varlist = ""
-        for var in self._branchRegistry[:-1]:
-            varlist += var
-            varlist += ":"
-        varlist += self._branchRegistry[-1]
-        return varlist
+        if len(self._tree_index) < 1:
+            return np.zeros(1, dtype=np.int64)
+
+        # An entry starts a new event if its runNumber or eventNumber differs
+        # from the previous one.
+        if self._event_keys is not None:
+            event_keys = self._event_keys[self._tree_index]
+            new_event  = event_keys[1:] != event_keys[:-1]
+        else:
+            run_numbers   = self._run_numbers[self._tree_index]
+            event_numbers = self._event_numbers[self._tree_index]
+            new_event     = ((run_numbers[1:]   != run_numbers[:-1])
+                             | (event_numbers[1:] != event_numbers[:-1]))
+
+        return np.concatenate(([0],
+                               np.flatnonzero(new_event) + 1,
+                               [len(self._tree_index)]))
 
-    def _mixAndFill(self, tuple, entry_index):
-        """Mix entry corresponding to the given index with the train.
+    def _mixAndFill(self, entries, mix_cand, out):
+        """Mix entries of an event with the train.
 
         Paramaters
         ----------
-        tuple : ROOT.TNtuple
-            TNtuple to fill with mixed candidates and daughters.
-        entry_index : long
-            Index of the entry to be mixed with the train.
+        entries : numpy.ndarray
+            Indexes of the entries of the event to be mixed with the train.
+        mix_cand : numpy.ndarray
+            Indexes of all the entries in the train, wagon after wagon.
+        out : numpy.ndarray
+            Filled with mixed candidates, daughters and weight. One row per
+            mixed candidate, entry after entry, one column per branch of the
+            saved tree.
         """
 
-        if self._verbose is True:
-            print self._train
-            print ("----------------------------------------------------")
-
-        # List of all the indexes in the train.
-        mix_cand = []
-        for key in self._train.keys():
-            mix_cand.extend(self._train[key])
-
-        # print len(self._train.keys())
-
-        # print len(mix_cand)
-
-        # Stems taken from train.
-        train_stems = self._stems[1:]
-
-        final_vector = ROOT.TLorentzVector()
-        # Need to have a list to keep the info up to saving to the tree.
-        mix_vectors = []
-        for j in range(len(train_stems)):
-            mix_vectors.append(ROOT.TLorentzVector())
-
-        for n in range(len(mix_cand)):
-            # Try to get last stem.
-            try:
-                mix_cand[n+len(train_stems)-1]
-            except IndexError:
-                continue
-
-            # Get entry associated with given index.
-            self._tree.GetEntry(entry_index)
-
-            # Filler used to copy M, PT and Y of daughter particles.
-            daughter_filler = [getattr(self._tree,
-                                       self._stems[0] + "_M")]
-            daughter_filler.append(getattr(self._tree,
-                                           self._stems[0] + "_PT"))
-            daughter_filler.append(getattr(self._tree,
-                                           self._stems[0] + "_Y"))
-
-            # Set current candidate 4-vector.
-            final_vector.SetPxPyPzE(getattr(self._tree,
-                                            self._stems[0] + "_PX"),
-                                    getattr(self._tree,
-                                            self._stems[0] + "_PY"),
-                                    getattr(self._tree,
-                                            self._stems[0] + "_PZ"),
-                                    getattr(self._tree,
-                                            self._stems[0] + "_PE"))
-
-            if self._verbose is True:
-                print self._stems[0], "from", entry_index, getattr(self._tree, "runNumber"), getattr(self._tree, "eventNumber")
-
-            for k, stem in enumerate(train_stems):
-
-                # Get index of train event.
-                train_index = mix_cand[n+k]
-                self._tree.GetEntry(train_index)
-
-                # Set train candidate 4-vector.
-                mix_vectors[k].SetPxPyPzE(getattr(self._tree, stem + "_PX"),
-                                          getattr(self._tree, stem + "_PY"),
-                                          getattr(self._tree, stem + "_PZ"),
-                                          getattr(self._tree, stem + "_PE"))
-
-                # Add candidate to mix 4-vector to final candidate 4-vector.
-                final_vector += mix_vectors[k]
-
-                daughter_filler.append(getattr(self._tree, stem + "_M" ))
-                daughter_filler.append(getattr(self._tree, stem + "_PT"))
-                daughter_filler.append(getattr(self._tree, stem + "_Y" ))
-
-                if self._verbose is True:
-                    print stem, "from", train_index, getattr(self._tree, "runNumber"), getattr(self._tree, "eventNumber")
-
-            # Fill tuple:
-            # Mixed candidate.
-            filler = [final_vector.M(),
-                      final_vector.Pt(),
-                      final_vector.Rapidity()]
-            # Daughter particules.
-            filler.extend(daughter_filler)
-            # Weight for first stem.
-            w = len(mix_cand) - len(train_stems) + 1
-            if self._verbose is True:
-                print "Weight :", w
+        # Number of mixed candidates per entry: the entry is mixed with every
+        # window of len(stems)-1 consecutive train entries. Also used as
+        # weight.
+        n_mix = len(out) // len(entries)
+        if n_mix < 1:
+            return
+
+        self._mix(self._p4, self._mpty, entries, mix_cand, out)
+
+        # Verbose output is stripped when running with python -O.
+        if __debug__ and self._verbose is True:
+            # Local references, avoiding attribute lookups in the loop.
+            run_numbers   = self._run_numbers
+            event_numbers = self._event_numbers
+            head          = self._stems[0]
+            # Stems taken from train.
+            train_stems   = self._stems[1:]
+            for entry_index in entries:
+                print(self._train)
                 print("----------------------------------------------------")
-            filler.append(w)
-            tuple.Fill(array.array('f', filler))
-
+                head_line = (head, "from", entry_index,
+                             run_numbers[entry_index],
+                             event_numbers[entry_index])
+                for n in range(n_mix):
+                    print(*head_line)
+                    for k, stem in enumerate(train_stems):
+                        train_index = mix_cand[n+k]
+                        print(stem, "from", train_index, run_numbers[train_index], event_numbers[train_index])
+                    print("Weight :", n_mix)
+                    print("----------------------------------------------------")
 
     def addMixCombination(self, mixed_cdt_name, stems):
         """Add a combination of branches to be mixed.
@@ -271,7 +513,7 @@ class AnnaMixEvent:
         muminus_PZ, ...
         In this case, the given stems must be ["muplus", "muminus"].
 
-        Branches of the output TNtuple will be named accordingly to the given
+        Branches of the output TTree will be named accordingly to the given
         mixed candidate name and stems: <mixed_cdt_name>_<variable>
         and <stem>_<variable>, where <variable> can be Y, PT, M.
 
@@ -288,35 +530,114 @@ class AnnaMixEvent:
             If one of the necessary branches for mixing is missing.
         """
 
-        # Check if every element of stems can be used to access PE, PX, PY
-        # and PZ branches in the tree.
-        branches = [stem + var for stem in stems for var in ["_PE", "_PX",
-                                                             "_PY", "_PZ"]]
+        # Names of the PX, PY, PZ, PE and M, PT, Y branches of every stem.
+        # Built once, then used for checking, loading and the registry.
+        p4_branches   = [[stem + var for var in ["_PX", "_PY", "_PZ", "_PE"]]
+                         for stem in stems]
+        mpty_branches = [[stem + var for var in ["_M", "_PT", "_Y"]]
+                         for stem in stems]
+        branches      = [branch for stem_branches in p4_branches + mpty_branches
+                                for branch in stem_branches]
+
+        # Check if every element of stems can be used to access PE, PX, PY,
+        # PZ, M, PT and Y branches in the tree.
         for branch in branches :
-            if branch not in self._tree.GetListOfBranches():
+            if branch not in self._tree_branches:
                 warnings.warn("'{}' is not a branch of the given tree, "
                               "expect problems!".format(branch))
 
         self._stems = stems
+        self._mix, self._mix_events = _getMixKernels(len(stems))
+
+        # Load daughters kinematics, shape (n_stems, n_variables, n_entries).
+        arrays = self._loadBranches(branches)
+        self._p4   = np.array([[arrays[branch] for branch in stem_branches]
+                               for stem_branches in p4_branches],
+                              dtype=np.float64)
+        self._mpty = np.array([[arrays[branch] for branch in stem_branches]
+                               for stem_branches in mpty_branches],
+                              dtype=np.float64)
 
         # Fill branch registry.
         vars              = ["_M", "_PT", "_Y"]
         mixed_branches    = [mixed_cdt_name + var for var in vars]
-        daughter_branches = [stem + var for stem in stems for var in vars]
+        daughter_branches = [branch for stem_branches in mpty_branches
+                                    for branch in stem_branches]
         self._branchRegistry.extend(mixed_branches)
         self._branchRegistry.extend(daughter_branches)
         self._branchRegistry.append("w_{}".format(stems[0]))
 
-        daughters_string = stems[0]
-        for stem in stems[1:]:
-            daughters_string += ", {}".format(stem)
+        daughters_string = ", ".join(stems)
 
         print("Will mix {} to form {}.".format(daughters_string,
                                                mixed_cdt_name))
 
+    def _mixSequential(self, event_boundaries, train_length, event_rows,
+                       output, first, last):
+        """Mix events one after the other, updating the train.
+
+        Parameters
+        ----------
+        event_boundaries : numpy.ndarray
+            See _buildEventBoundaries.
+        train_length : int
+            Number of events in the train.
+        event_rows : numpy.ndarray
+            First row of every event in the saved tree, followed by the
+            number of rows of the saved tree.
+        output : numpy.ndarray
+            Rows of the saved tree filled by events first to last, one row
+            per branch.
+        first : int
+            First event to mix.
+        last : int
+            Event following the last one to mix.
+        """
+
+        # Local references, avoiding attribute lookups in the loop.
+        mix_and_fill = self._mixAndFill
+        tree_index   = self._tree_index
+        n_events     = len(event_boundaries) - 1
+        offset       = event_rows[first]
+
+        # Fill train with the events preceding the first one, most recent
+        # first, wrapping around to the last events of the tree.
+        train_events = [(first - j) % n_events
+                        for j in range(1, train_length + 1)]
+        self._train  = deque((tree_index[event_boundaries[h]:
+                                         event_boundaries[h+1]]
+                              for h in train_events),
+                             maxlen=train_length)
+
+        # List of all the indexes in the train.
+        mix_cand = np.fromiter(chain.from_iterable(self._train),
+                               dtype=np.int64)
+
+        for g in range(first, last):
+            if g > first:
+                # Update train:
+                # Dump last wagon of train.
+                dumped_wagon = self._train.pop()
+                # Add previous event wagon to the train.
+                new_wagon = tree_index[event_boundaries[g-1]:
+                                       event_boundaries[g]]
+                self._train.appendleft(new_wagon)
+                # Update list of indexes in the train the same way.
+                mix_cand = np.concatenate(
+                    (new_wagon, mix_cand[:len(mix_cand)-len(dumped_wagon)]))
+
+            # Mix event wagon with train.
+            evt_wagon = tree_index[event_boundaries[g]:event_boundaries[g+1]]
+            mix_and_fill(evt_wagon, mix_cand,
+                         output[:, event_rows[g]-offset:
+                                   event_rows[g+1]-offset].T)
+
     def runMixing(self, progress=False, verbose=False):
         """Method used to run mixing.
 
+        Events are mixed and saved by chunks of about 1% of the events, so
+        that only one chunk of the saved tree is held in memory.
+
         Parameters
         ----------
         progress : bool
@@ -328,163 +649,100 @@ class AnnaMixEvent:
             every particles being mixed, as well as the weight value.
             HUGE perfomance impact.
             Default is False.
+
+        Warns
+        -----
+        UserWarning
+            If the given tree is empty, if the train is longer than the
+            number of other events or if the saved tree is empty.
         """
 
         self._progress = progress
         self._verbose  = verbose
 
-        # Build varlist for saved tuple.
-        varlist = self._buildVarlist()
-
-        # Test
-        # print self._branchRegistry
-        # print varlist
-
-        # Open file to save tuple.
-        with ROOT.TFile(self._outfile_path, "RECREATE") as outfile:
-            # Create tuple to be saved.
-            new_tuple = ROOT.TNtuple("mt", "mixing tuple", varlist)
-
-            # Initialize counters.
-            wagon_counter = 0 # Number of different events processed.
-
-            # Get size of index.
-            index_size = self._tree_index.GetN()
-
-            # Wagons.
-            evt_wagon  = [] # Wagon of entries to be mixed with train.
-            strd_wagon = [] # Stored wagon to be used later.
+        # Positions of the first entry of every event in the index.
+        event_boundaries = self._buildEventBoundaries()
+
+        n_events = len(event_boundaries) - 1
+        if n_events < 1:
+            warnings.warn("Given tree is empty, nothing to mix !")
+            return
+
+        # An event must not be mixed with itself.
+        train_length = self._train_length
+        if train_length > n_events - 1:
+            train_length = n_events - 1
+            warnings.warn("Train is longer than the number of other "
+                          "events, using a train length of "
+                          "{}.".format(train_length))
+
+        # Number of entries in the train of every event: the train_length
+        # events preceding it, wrapping around to the last events of the tree.
+        event_sizes = np.diff(event_boundaries)
+        cumulated   = np.cumsum(np.concatenate(
+            ([0], event_sizes[n_events-train_length:], event_sizes)))
+        train_sizes = (cumulated[train_length:train_length+n_events]
+                       - cumulated[:n_events])
+
+        # Rows of the saved tree filled by every event, each entry being mixed
+        # with every window of len(stems)-1 consecutive train entries.
+        n_mix       = np.maximum(train_sizes - len(self._stems) + 2, 0)
+        event_rows  = np.cumsum(np.concatenate(([0], event_sizes * n_mix)))
+
+        # Chunks of events, between which progress is printed.
+        chunk_size  = max(n_events // 100, 1)
+        firsts      = np.arange(0, n_events, chunk_size)
+        lasts       = np.minimum(firsts + chunk_size, n_events)
+
+        # Rows of the saved tree filled by a chunk, one row per branch,
+        # allocated once for the largest chunk.
+        buffer = np.empty((len(self._branchRegistry),
+                           np.max(event_rows[lasts] - event_rows[firsts])),
+                          dtype=np.float64)
+
+        # Verbose output needs entries to be mixed one after the other.
+        parallel   = self._mix_events is not None and self._verbose is not True
+        index_size = len(self._tree_index)
+
+        # Chunks are saved next to the output file, then merged in it by
+        # copying their compressed baskets, keeping the order of the events.
+        outfile_dir = os.path.dirname(os.path.abspath(self._outfile_path))
+        with tempfile.TemporaryDirectory(dir=outfile_dir) as chunk_dir:
+            merger = ROOT.TFileMerger(False)
+            merger.OutputFile(self._outfile_path, "RECREATE")
+
+            for first, last in zip(firsts.tolist(), lasts.tolist()):
+                output = buffer[:, :event_rows[last]-event_rows[first]]
+                if parallel:
+                    self._mix_events(self._p4, self._mpty, self._tree_index,
+                                     event_boundaries, train_length,
+                                     event_rows, output, first, last)
+                else:
+                    self._mixSequential(event_boundaries, train_length,
+                                        event_rows, output, first, last)
+
+                # Save chunk, writing all branches at once.
+                chunk_path = os.path.join(chunk_dir,
+                                          "chunk_{}.root".format(first))
+                columns    = dict(zip(self._branchRegistry, output))
+                with _implicitMTDisabled():
+                    _fromNumpy(columns).Snapshot("mt", chunk_path)
+                merger.AddFile(chunk_path)
 
-            # Add first ordered entry to train.
-            self._tree.GetEntry(self._tree_index.GetIndex()[0])
-            evt_wagon.append((self._tree_index.GetIndex()[0],
-                              getattr(self._tree, "runNumber"),
-                              getattr(self._tree, "eventNumber")))
-
-            # Print progress if asked.
-            if self._progress is True:
-                sys.stdout.write("Processing entry 1/{} ({}%)".format(index_size, 100/index_size))
-
-            # Run over ordered entries except the first one.
-            for i in range(index_size)[1:]:
                 # Print progress if asked.
                 if self._progress is True:
-                    sys.stdout.write("\rProcessing entry {}/{} ({}%)".format(i+1, index_size, (i+1)*100/index_size))
-
-                cur_tree_index = self._tree_index.GetIndex()[i]
-                self._tree.GetEntry(cur_tree_index)
-
-                # Get current entry runNumber and eventNumber.
-                cur_entry = (cur_tree_index,
-                             getattr(self._tree, "runNumber"),
-                             getattr(self._tree, "eventNumber"))
-
-                # Get last entry stored in train.
-                prev_entry = evt_wagon[-1]
-
-                # Fill wagon until a new event is met.
-                if cur_entry[1:] == prev_entry[1:]:
-                    evt_wagon.append(cur_entry)
-                    continue
-
-                # When a new event is met, if train is empty.
-                elif len(self._train.keys()) < 1:
-                    # Counter for number of reversed event.
-                    reverse_counter = 1
-                    # Fill train with last events from the given tree.
-                    # Get last ordered entry of the tree.
-                    cur_rev_index = self._tree_index.GetIndex()[index_size-1]
-                    self._tree.GetEntry(cur_rev_index)
-                    cur_nrun   = getattr(self._tree, "runNumber")
-                    cur_nevent = getattr(self._tree, "eventNumber")
-                    cur_train_key = "{}_{}".format(cur_nrun, cur_nevent)
-
-                    # Create dictionnary key and add current index.
-                    self._train[cur_train_key] = [cur_rev_index]
-
-                    for j in reversed(range(index_size - 1)):
-                        # Get index, runNumber and eventNumber.
-                        cur_rev_index  = self._tree_index.GetIndex()[j]
-                        self._tree.GetEntry(cur_rev_index)
-                        cur_nrun   = getattr(self._tree, "runNumber")
-                        cur_nevent = getattr(self._tree, "eventNumber")
-                        cur_train_key = "{}_{}".format(cur_nrun, cur_nevent)
-
-                        if cur_train_key == self._train.keys()[-1]:
-                            # Add current index to the dictionnary.
-                            self._train[cur_train_key].append(cur_rev_index)
-
-                            continue
-
-                        elif reverse_counter < self._train_length:
-                            # If train is not complete, start another wagon.
-                            self._train[cur_train_key] = [cur_rev_index]
-                            reverse_counter += 1
-
-                            continue
-
-                        else:
-                            # When train is full, mix event wagon with it.
-                            for wagon_entry in evt_wagon:
-                                self._mixAndFill(new_tuple, wagon_entry[0])
-
-                            # Store and replace event wagon content with
-                            # current entry.
-                            strd_wagon = evt_wagon
-                            evt_wagon  = [cur_entry]
-
-                            wagon_counter += 1
-
-                            break
-
-                    continue
-
-                # When a new event is met, but train is neither empty nor full.
-                else : # elif wagon_counter < self._train_length:
-                    # Update train:
-                    # Dump last wagon of train.
-                    del self._train[self._train.keys()[-1]]
-                    # Create new key.
-                    new_key = "{}_{}".format(strd_wagon[0][1], strd_wagon[0][2])
-                    # Add stored wagon to the train.
-                    self._train.prepend(new_key, [a[0] for a in strd_wagon])
-
-                    # Mix event wagon with train.
-                    for wagon_entry in evt_wagon:
-                        self._mixAndFill(new_tuple, wagon_entry[0])
-
-                    # Store and replace event wagon content with current entry.
-                    strd_wagon = evt_wagon
-                    evt_wagon  = [cur_entry]
-
-                    wagon_counter += 1
-
-                    continue
-
-            # At the end of the tree, mix last event.
-
-            # Update train:
-            # Dump last wagon of train.
-            del self._train[self._train.keys()[-1]]
-            # Create new key.
-            new_key = "{}_{}".format(strd_wagon[0][1], strd_wagon[0][2])
-            # Add stored wagon to the train.
-            self._train.prepend(new_key, [a[0] for a in strd_wagon])
-
-            # Mix event wagon with train.
-            for wagon_entry in evt_wagon:
-                self._mixAndFill(new_tuple, wagon_entry[0])
-
-            wagon_counter += 1
-
-            try:
-                assert new_tuple.GetEntries() > 0
-            except AssertionError:
-                warnings.warn("Saved tuple is empty !")
-
-            outfile[new_tuple.GetName()] = new_tuple
+                    n_entries = event_boundaries[last]
+                    sys.stdout.write("\rProcessing entry {}/{} ({}%)".format(n_entries, index_size, n_entries*100//index_size))
 
             if self._progress is True:
                 sys.stdout.write("\n")
 
-            print("Mixing done on {} events.".format(wagon_counter))
+            if event_rows[-1] < 1:
+                warnings.warn("Saved tree is empty !")
+
+            # Save tree.
+            if not merger.Merge():
+                warnings.warn("Could not merge chunks in "
+                              "{}.".format(self._outfile_path))
+
+        print("Mixing done on {} events.".format(n_events))